@@ -11,21 +11,26 @@ cred = credentials.Certificate("serviceAccountKey.json")
 firebase_admin.initialize_app(cred)
 db = firestore.client()
 
+# WriteBatchの1コミットあたりの書き込み数（上限500）
+FIRESTORE_BATCH_LIMIT = 400
+
 def assign_random_numbers():
     try:
-        # statusが'unprocessed'のドキュメントを取得
-        unprocessed_docs = db.collection('document_metadata').where('status', '==', 'unprocessed').stream()
-        
-        for doc in unprocessed_docs:
-            # 1から6までのランダムな数字を生成
-            random_number = random.randint(1, 6)
-            
-            # ドキュメントを更新
-            db.collection('document_metadata').document(doc.id).update({
-                'random': random_number
-            })
-            print(f"ドキュメントID {doc.id} にランダムな数字 {random_number} を割り当てました")
-            
+        # statusが'unprocessed'のドキュメントの参照のみを取得
+        unprocessed_docs = db.collection('document_metadata').where('status', '==', 'unprocessed').select([]).stream()
+        refs = [doc.reference for doc in unprocessed_docs]
+
+        # 1から6までのランダムな数字をまとめて生成
+        random_numbers = random.choices(range(1, 7), k=len(refs))
+
+        # WriteBatchでまとめて更新
+        for i in range(0, len(refs), FIRESTORE_BATCH_LIMIT):
+            batch = db.batch()
+            for ref, random_number in zip(refs[i:i + FIRESTORE_BATCH_LIMIT], random_numbers[i:i + FIRESTORE_BATCH_LIMIT]):
+                batch.update(ref, {'random': random_number})
+            batch.commit()
+        print(f"{len(refs)} 件のドキュメントにランダムな数字を割り当てました")
+
     except Exception as e:
         print(f"エラーが発生しました: {str(e)}")
         return None
@@ -0,0 +1,3 @@
+from .transcriber import Transcriber
+
+__all__ = ["Transcriber"]
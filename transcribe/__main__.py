@@ -0,0 +1,26 @@
+import argparse
+import logging
+
+from .transcriber import Transcriber
+
+def main():
+    parser = argparse.ArgumentParser(description="Firebase上のPDFをGeminiで1ページずつ文字起こし")
+    parser.add_argument(
+        "--mode",
+        choices=["one", "missing"],
+        default="one",
+        help="one: 未処理ドキュメントを文字起こし / missing: 処理済みドキュメントの不足ページを再処理"
+    )
+    parser.add_argument(
+        "--bucket",
+        type=int,
+        default=None,
+        help="document_metadataのrandomの値（1〜6）。省略時はすべてのドキュメントが対象"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    Transcriber(args.bucket, args.mode).run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+import os
+import logging
+from dotenv import load_dotenv
+import firebase_admin
+from firebase_admin import credentials, firestore, storage
+from google.cloud.firestore_v1.base_query import FieldFilter
+from pypdf import PdfReader, PdfWriter
+import io
+import tempfile
+from google import genai
+from google.genai import types, errors
+from aiolimiter import AsyncLimiter
+from typing import List, Dict, Tuple, Iterator, Optional, Literal
+import asyncio
+import random
+import functools
+import hashlib
+from itertools import islice
+import diskcache
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+cred = credentials.Certificate("serviceAccountKey.json")
+firebase_admin.initialize_app(cred, {
+    "storageBucket": "studyfellow-42d35.firebasestorage.app"  # ← ご自身のバケット名に変更
+})
+db = firestore.client()
+bucket = storage.bucket()
+
+# WriteBatchの1コミットあたりの書き込み数（上限500）
+FIRESTORE_BATCH_LIMIT = 400
+
+# Gemini APIへの同時リクエスト数と1秒あたりのリクエスト数の上限
+MAX_INFLIGHT = 10
+REQUESTS_PER_SECOND = 5
+
+# 429 / 5xx に対する指数バックオフの設定
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 60
+
+# 同時に処理するファイル数の上限（Storageの帯域を抑える）
+MAX_CONCURRENT_FILES = 4
+
+# ページのPDFデータのsha256 → 文字起こし結果のディスクキャッシュ（再実行時にGemini APIを呼ばない）
+TRANSCRIPTION_CACHE_DIR = ".transcription_cache"
+_CACHE = diskcache.Cache(TRANSCRIPTION_CACHE_DIR)
+_BLOCKED = None  # 著作権などでブロックされたページをキャッシュする際の値
+
+# 文字起こしのプロンプトと生成設定（呼び出しごとに作り直さない）
+_PROMPT = """
+数式はTeX形式で記述してください。
+pdf内にグラフや図表があった場合、グラフや図表の説明を文字起こしした文章の適切な位置に挿入してください。
+ページ番号やヘッダーフッターに書かれた共通の章タイトルを含めることを禁止します。
+"""
+_CONFIG = types.GenerateContentConfig(
+    system_instruction="あなたは柔軟性を持つ文字起こしAIです。ユーザーの指示に従ってPDFをMarkdown形式で文字起こしして結果のみ表示してください。不自然に文の途中で改行することを禁止します。"
+)
+
+def iter_pages(reader: PdfReader, page_numbers: Optional[List[int]] = None) -> Iterator[Tuple[int, bytes]]:
+    """PDFを1ページずつ分割し、(ページ番号, PDFデータ) を順に返す（page_numbers指定時はそのページのみ）"""
+    pages = reader.pages
+    total_pages = len(pages)
+    if page_numbers is None:
+        page_numbers = range(1, total_pages + 1)
+    buffer = io.BytesIO()  # 全ページで同じバッファを使い回す
+
+    for page_num in page_numbers:
+        if page_num <= total_pages:
+            writer = PdfWriter()
+            writer.add_page(pages[page_num - 1])  # ページ番号は1ベースだが、インデックスは0ベース
+
+            buffer.seek(0)
+            buffer.truncate()
+            writer.write(buffer)
+            with buffer.getbuffer() as view:
+                pdf_data = view.tobytes()
+            yield page_num, pdf_data
+
+@functools.lru_cache(maxsize=None)
+def get_client(api_key_env: str) -> genai.Client:
+    """プロセス内で共有するGeminiクライアントを取得（接続プールと認証情報を再利用）"""
+    return genai.Client(api_key=os.environ.get(api_key_env))
+
+def is_retryable_error(e: Exception) -> bool:
+    """429（RESOURCE_EXHAUSTED）と5xxを一時的なエラーとして判定"""
+    return isinstance(e, errors.ServerError) or (isinstance(e, errors.ClientError) and e.code == 429)
+
+def save_to_firestore(results: List[Tuple[str, int]], file_name: str, document_id: str):
+    """文字起こし結果をWriteBatchでまとめてFirestoreに保存"""
+    try:
+        collection = db.collection('document_transcriptions')
+        for i in range(0, len(results), FIRESTORE_BATCH_LIMIT):
+            batch = db.batch()
+            for transcription, page in results[i:i + FIRESTORE_BATCH_LIMIT]:
+                data = {
+                    "transcription": transcription,
+                    "page": page,
+                    "file_name": file_name,
+                    "document_id": document_id
+                }
+                batch.set(collection.document(), data)
+            batch.commit()
+        logger.info(f"{len(results)} ページの結果を保存しました")
+    except Exception as e:
+        logger.error(f"保存中にエラーが発生しました: {str(e)}")
+        return None
+
+def delete_transcriptions(document_id: str):
+    """document_idに紐づく文字起こしをWriteBatchでまとめて削除"""
+    trans_docs = db.collection('document_transcriptions').where(filter=FieldFilter('document_id', '==', document_id)).select([]).stream()
+    refs = [tdoc.reference for tdoc in trans_docs]
+    for i in range(0, len(refs), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for ref in refs[i:i + FIRESTORE_BATCH_LIMIT]:
+            batch.delete(ref)
+        batch.commit()
+
+def get_missing_pages(document_id: str, total_pages: int) -> List[int]:
+    """存在しないページ番号を取得"""
+    try:
+        query = db.collection('document_transcriptions').where(filter=FieldFilter('document_id', '==', document_id))
+
+        # 1〜total_pagesのページ番号だけをページ順に取得し、1回の走査で欠番を求める
+        # （同じページが重複して保存されることがあるため、件数だけでは判定しない）
+        page_docs = (
+            query.where(filter=FieldFilter('page', '>=', 1))
+            .where(filter=FieldFilter('page', '<=', total_pages))
+            .order_by('page')
+            .select(['page'])
+            .stream()
+        )
+        missing_pages = []
+        existing_pages = 0
+        expected = 1
+        for doc in page_docs:
+            page_num = doc.to_dict().get('page')
+            if page_num < expected:  # 同じページの重複
+                continue
+            missing_pages.extend(range(expected, page_num))
+            existing_pages += 1
+            expected = page_num + 1
+        missing_pages.extend(range(expected, total_pages + 1))
+
+        logger.info(f"ドキュメントID {document_id}: 総ページ数 {total_pages}, 既存ページ数 {existing_pages}, 不足ページ数 {len(missing_pages)}")
+        if missing_pages:
+            logger.debug(f"不足ページ: {missing_pages}")
+
+        return missing_pages
+
+    except Exception as e:
+        logger.error(f"ページ確認中にエラーが発生しました: {str(e)}")
+        return []
+
+class Transcriber:
+    """document_metadataのrandomバケットごとにPDFを1ページずつ文字起こしする
+
+    mode='one'     : 未処理（unprocessed）ドキュメントを全ページ文字起こしする
+    mode='missing' : 処理済み（processed）ドキュメントの不足ページのみを再処理する
+    random_bucket=None の場合はrandomで絞り込まず、すべてのドキュメントを対象にする
+    """
+
+    def __init__(self, random_bucket: Optional[int], mode: Literal['one', 'missing']):
+        if mode not in ('one', 'missing'):
+            raise ValueError(f"不明なモードです: {mode}")
+        self.random_bucket = random_bucket
+        self.mode = mode
+        # バケット1（および全件対象）はGOOGLE_API_KEY、それ以外はGOOGLE_API_KEY_{n}を使う
+        if random_bucket is None or random_bucket == 1:
+            self.api_key_env = "GOOGLE_API_KEY"
+        else:
+            self.api_key_env = f"GOOGLE_API_KEY_{random_bucket}"
+        # 再処理では空のレスポンスやエラーも「内容なし」として保存し、同じページを繰り返し処理しない
+        self.empty_result = "内容なし" if mode == 'missing' else ""
+        self._sem = asyncio.Semaphore(MAX_INFLIGHT)
+        self._limiter = AsyncLimiter(REQUESTS_PER_SECOND, 1)
+        self._file_sem = asyncio.Semaphore(MAX_CONCURRENT_FILES)
+
+    @property
+    def client(self) -> genai.Client:
+        return get_client(self.api_key_env)
+
+    def _metadata_query(self, status: str):
+        """statusと（指定されていれば）randomでdocument_metadataを絞り込むクエリ"""
+        query = db.collection('document_metadata').where(filter=FieldFilter('status', '==', status))
+        if self.random_bucket is not None:
+            query = query.where(filter=FieldFilter('random', '==', self.random_bucket))
+        return query
+
+    def _cached_result(self, text: Optional[str]) -> str:
+        """キャッシュした値をモードに応じた戻り値に変換"""
+        if text is _BLOCKED:
+            return ""
+        return text or self.empty_result
+
+    async def transcribe_pdf(self, pdf_data, page: int):
+        """PDFデータを文字起こし"""
+        # 同じページデータは同じ結果になるため、キャッシュがあればネットワークに出ない
+        key = hashlib.sha256(pdf_data).hexdigest()
+        cached = _CACHE.get(key, default=False)
+        if cached is not False:
+            logger.debug(f"ページ {page} はキャッシュ済みの結果を使います")
+            return self._cached_result(cached)
+
+        try:
+            for attempt in range(MAX_RETRIES):
+                try:
+                    async with self._sem, self._limiter:
+                        response = await self.client.aio.models.generate_content(
+                            model="gemini-2.5-flash-preview-05-20",
+                            config=_CONFIG,
+                            contents=[
+                                types.Part.from_bytes(
+                                    data=pdf_data,
+                                    mime_type='application/pdf'
+                                ),
+                                _PROMPT
+                            ]
+                        )
+                    break
+                except errors.APIError as e:
+                    if not is_retryable_error(e) or attempt == MAX_RETRIES - 1:
+                        raise
+                    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) + random.uniform(0, 1)
+                    logger.warning(f"ページ {page} のリクエストが一時的に失敗しました。{delay:.1f}秒後に再試行します: {str(e)}")
+                    await asyncio.sleep(delay)
+
+            if not response.candidates:
+                logger.warning(f"ページ {page} の処理がスキップされました（著作権の可能性があります）")
+                _CACHE.set(key, _BLOCKED)
+                return ""
+
+            if not response.text:
+                logger.warning(f"ページ {page} の処理がスキップされました（レスポンスが空です）")
+                _CACHE.set(key, "")
+                return self.empty_result
+
+            logger.debug("ページ %s の処理結果:\n%s", page, response.text)
+
+            # 一時的なエラーや例外の結果はキャッシュせず、次回に再試行する
+            _CACHE.set(key, response.text)
+            return response.text
+
+        except Exception as e:
+            if is_retryable_error(e):
+                # 一時的なエラーは保存せず、不足ページとして次回の再処理に回す
+                logger.warning(f"ページ {page} は再試行の上限に達したためスキップします: {str(e)}")
+                return ""
+            logger.error(f"ページ {page} の文字起こし中にエラーが発生しました: {str(e)}")
+            return self.empty_result
+
+    async def transcribe_batch(self, pdf_batch: List[Tuple[int, bytes]]) -> List[Tuple[str, int]]:
+        """ページのバッチを並列に文字起こしし、完了した順に結果を回収"""
+        async def transcribe_page(page: int, pdf_data: bytes) -> Tuple[str, int]:
+            return await self.transcribe_pdf(pdf_data, page), page
+
+        results = []
+        for coro in asyncio.as_completed([transcribe_page(page, pdf_data) for page, pdf_data in pdf_batch]):
+            transcription, page = await coro
+            if transcription:  # 空文字列以外（「内容なし」も含む）は保存
+                results.append((transcription, page))
+        return results
+
+    async def process_page_batch(self, pdf_batch: List[Tuple[int, bytes]], file_name: str, doc_id: str):
+        """ページのバッチを並列処理"""
+        results = await self.transcribe_batch(pdf_batch)
+        if results:
+            await asyncio.to_thread(save_to_firestore, results, file_name, doc_id)
+
+    async def process_pages(self, page_iter: Iterator[Tuple[int, bytes]], file_name: str, doc_id: str):
+        """ページを100ページずつ取り出して処理（前のバッチの保存と次のバッチの文字起こしを重ねる）"""
+        batch_size = 100
+        pending = None
+        # メモリ上に保持するページは実行中と次のバッチの最大2バッチ分
+        while batch := await asyncio.to_thread(lambda: list(islice(page_iter, batch_size))):
+            logger.info(f"ページ {batch[0][0]} から {batch[-1][0]} のバッチ処理を開始します（{len(batch)} ページ）...")
+            task = asyncio.create_task(self.process_page_batch(batch, file_name, doc_id))
+            if pending:
+                await pending
+            pending = task
+        if pending:
+            await pending
+
+    async def process_one_file(self, doc: Dict):
+        """1ファイル分のPDFを分割して文字起こし（missingモードでは不足ページのみ）"""
+        file_name = doc.get('file_name')
+        doc_id = doc.get('id')
+        file_path = doc.get('path')  # Firestoreのpathフィールドを利用
+        page_numbers = None
+
+        if self.mode == 'missing':
+            total_pages = doc.get('total_pages')
+            if not total_pages:
+                logger.warning(f"ファイル {file_name}: total_pagesが設定されていないため、スキップします")
+                return
+
+        async with self._file_sem:
+            logger.info(f"ファイル {file_name} の処理を開始します...")
+
+            if self.mode == 'missing':
+                # 不足ページを特定
+                page_numbers = await asyncio.to_thread(get_missing_pages, doc_id, total_pages)
+                if not page_numbers:
+                    logger.info(f"ファイル {file_name}: すべてのページが処理済みです")
+                    return
+
+            try:
+                # Firebase Storageから一時ファイルへストリーミングでダウンロード（PDF全体をメモリに載せない）
+                blob = bucket.blob(file_path)
+                with tempfile.NamedTemporaryFile(suffix='.pdf') as tf:
+                    await asyncio.to_thread(blob.download_to_file, tf)
+                    tf.flush()
+                    tf.seek(0)
+                    logger.info(f"ファイル {file_name} のダウンロードが完了しました")
+                    reader = await asyncio.to_thread(PdfReader, tf)
+                    await self.process_pages(iter_pages(reader, page_numbers), file_name, doc_id)
+                if self.mode == 'one':
+                    await asyncio.to_thread(db.collection('document_metadata').document(doc_id).update, {'status': 'processed'})
+                logger.info(f"ファイル {file_name} の処理が完了しました")
+            except Exception as e:
+                logger.error(f"ファイル {file_name} の処理中にエラーが発生しました: {str(e)}")
+
+    def cleanup(self):
+        """削除済みドキュメントと、未処理ドキュメントに残った途中の文字起こしを削除"""
+        # 削除されたドキュメントの処理
+        deleted_docs = db.collection('document_metadata').where(filter=FieldFilter('status', '==', 'deleted')).select([]).stream()
+        for doc in deleted_docs:
+            doc_id = doc.id
+            # document_transcriptionsの削除
+            delete_transcriptions(doc_id)
+            logger.info(f"ドキュメントID {doc_id} の文字起こしデータを削除しました")
+            # ステータス更新
+            db.collection('document_metadata').document(doc_id).update({'status': 'deleted_applied'})
+            logger.info(f"ドキュメントID {doc_id} のステータスをdeleted_appliedに更新しました")
+
+        # 担当バケットのunprocessedなドキュメントに紐づくdocument_transcriptionsを削除
+        # （他のバケットを処理中のワーカーのデータは消さない）
+        unprocessed_docs = self._metadata_query('unprocessed').select([]).stream()
+        for doc in unprocessed_docs:
+            delete_transcriptions(doc.id)
+        logger.info(f"unprocessedなdocument_metadataに紐づくdocument_transcriptionsを全削除しました")
+
+    async def process_documents(self):
+        try:
+            if self.mode == 'one':
+                await asyncio.to_thread(self.cleanup)
+                # 未処理ドキュメントの取得
+                response = self._metadata_query('unprocessed').select(['file_name', 'path']).stream()
+            else:
+                # 処理済みドキュメントを取得
+                response = self._metadata_query('processed').select(['file_name', 'path', 'total_pages']).stream()
+            docs = [doc.to_dict() | {'id': doc.id} for doc in response]
+
+            if not docs:
+                logger.info("処理対象のドキュメントが見つかりませんでした。")
+                return None
+
+            logger.info(f"処理対象のドキュメント数: {len(docs)}")
+
+            await asyncio.gather(*(self.process_one_file(doc) for doc in docs), return_exceptions=True)
+        except Exception as e:
+            logger.error(f"エラーが発生しました: {str(e)}")
+            return None
+
+    def run(self):
+        asyncio.run(self.process_documents())
@@ -1,83 +1,82 @@
 import os
+import logging
 from dotenv import load_dotenv
 from supabase import create_client, Client
-from PyPDF2 import PdfReader, PdfWriter
+from pypdf import PdfReader, PdfWriter
 import io
 import google.generativeai as genai
 
 load_dotenv()
 
-def split_pdf_in_memory(pdf_data):
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+logger = logging.getLogger(__name__)
+
+# Gemini APIの初期化（プロセス内で1度だけ行いモデルを再利用）
+genai.configure(api_key=os.environ.get("GOOGLE_API_KEY"))
+MODEL = genai.GenerativeModel(
+    model_name="gemini-2.5-flash-preview-04-17",
+    system_instruction="""
+    あなたは柔軟性を持つ文字起こしAIです。ユーザーの指示に従ってPDFをMarkdown形式で文字起こしして結果のみ表示してください。
+    不自然に文の途中で改行することを禁止します。
+    """
+)
+
+# 文字起こしのプロンプト（呼び出しごとに作り直さない）
+_PROMPT = """
+数式はTeX形式で記述してください。
+pdf内にグラフや図表があった場合、グラフや図表の説明を文字起こしした文章の適切な位置に挿入してください。
+ページ番号やヘッダーフッターに書かれた共通の章タイトルを含めることを禁止します。
+"""
+
+def split_pdf_in_memory(reader: PdfReader):
     """PDFを表紙と2ページずつに分割してメモリ上で保持"""
-    reader = PdfReader(io.BytesIO(pdf_data))
-    total_pages = len(reader.pages)
+    pages = reader.pages
+    total_pages = len(pages)
     split_pdfs = []
     
-    cover_writer = PdfWriter()
-    cover_writer.add_page(reader.pages[0])
-    cover_buffer = io.BytesIO()
-    cover_writer.write(cover_buffer)
-    split_pdfs.append({
-        "name": "cover",
-        "data": cover_buffer.getvalue(),
-        "page": 1
-    })
-    print("表紙の分割が完了しました")
+    # 表紙は単独、以降は2ページずつ（名前, 開始インデックス, 終了インデックス）
+    chunks = [("cover", 0, 1)]
+    chunks += [(f"pages_{i+1}", i, min(i + 2, total_pages)) for i in range(1, total_pages, 2)]
     
-    for i in range(1, total_pages, 2):
+    buffer = io.BytesIO()  # 全チャンクで同じバッファを使い回す
+    for name, start, end in chunks:
         writer = PdfWriter()
-        writer.add_page(reader.pages[i])
-        if i + 1 < total_pages:
-            writer.add_page(reader.pages[i + 1])
+        for i in range(start, end):
+            writer.add_page(pages[i])
         
-        buffer = io.BytesIO()
+        buffer.seek(0)
+        buffer.truncate()
         writer.write(buffer)
-        split_pdfs.append({
-            "name": f"pages_{i+1}",
-            "data": buffer.getvalue(),
-            "page": i + 1
-        })
-        print(f"ページ {i+1} の分割が完了しました")
+        with buffer.getbuffer() as view:
+            split_pdfs.append({
+                "name": name,
+                "data": view.tobytes(),
+                "page": start + 1
+            })
     
     return split_pdfs
 
 def transcribe_pdf(pdf_data, page: int):
     """PDFデータを文字起こし"""
     try:
-        genai.configure(api_key=os.environ.get("GOOGLE_API_KEY"))
-        model = genai.GenerativeModel(
-            model_name="gemini-2.5-flash-preview-04-17",
-            system_instruction="""
-            あなたは柔軟性を持つ文字起こしAIです。ユーザーの指示に従ってPDFをMarkdown形式で文字起こしして結果のみ表示してください。
-            不自然に文の途中で改行することを禁止します。
-            """
-        )
-        
-        prompt = """
-        数式はTeX形式で記述してください。
-        pdf内にグラフや図表があった場合、グラフや図表の説明を文字起こしした文章の適切な位置に挿入してください。
-        ページ番号やヘッダーフッターに書かれた共通の章タイトルを含めることを禁止します。
-        """
-        
-        response = model.generate_content(
-            [prompt, {"mime_type": "application/pdf", "data": pdf_data}]
+        response = MODEL.generate_content(
+            [_PROMPT, {"mime_type": "application/pdf", "data": pdf_data}]
         )
         
         if not response.candidates:
-            print(f"ページ {page} の処理がスキップされました（著作権の可能性があります）")
+            logger.warning(f"ページ {page} の処理がスキップされました（著作権の可能性があります）")
             return ""
             
         if not response.text:
-            print(f"ページ {page} の処理がスキップされました（レスポンスが空です）")
+            logger.warning(f"ページ {page} の処理がスキップされました（レスポンスが空です）")
             return ""
         
-        print(f"\nページ {page} の処理結果:")
-        print(response.text)
+        logger.debug("ページ %s の処理結果:\n%s", page, response.text)
         
         return response.text
         
     except Exception as e:
-        print(f"ページ {page} の文字起こし中にエラーが発生しました: {str(e)}")
+        logger.error(f"ページ {page} の文字起こし中にエラーが発生しました: {str(e)}")
         return ""
 
 def save_to_supabase(supabase: Client, transcription: str, page: int, file_name: str, document_id: str):
@@ -91,10 +90,10 @@ def save_to_supabase(supabase: Client, transcription: str, page: int, file_name:
         }
         
         response = supabase.table('document_transcriptions').insert(data).execute()
-        print(f"ページ {page} の結果を保存しました")
+        logger.debug(f"ページ {page} の結果を保存しました")
         return response.data
     except Exception as e:
-        print(f"保存中にエラーが発生しました: {str(e)}")
+        logger.error(f"保存中にエラーが発生しました: {str(e)}")
         return None
 
 def process_documents():
@@ -109,43 +108,45 @@ def process_documents():
             for doc in deleted_docs.data:
                 doc_id = doc.get('id')
                 supabase.table('document_transcriptions').delete().eq('document_id', doc_id).execute()
-                print(f"ドキュメントID {doc_id} の文字起こしデータを削除しました")
+                logger.info(f"ドキュメントID {doc_id} の文字起こしデータを削除しました")
                 
                 supabase.table('document_metadata').update({'status': 'deleted_applied'}).eq('id', doc_id).execute()
-                print(f"ドキュメントID {doc_id} のステータスをdeleted_appliedに更新しました")
+                logger.info(f"ドキュメントID {doc_id} のステータスをdeleted_appliedに更新しました")
         
         response = supabase.table('document_metadata').select("*").eq('status', 'unprocessed').execute()
         
         if not response.data:
-            print("処理待ちのドキュメントが見つかりませんでした。")
+            logger.info("処理待ちのドキュメントが見つかりませんでした。")
             return None
             
         for doc in response.data:
             file_name = doc.get('file_name')
             doc_id = doc.get('id')
             bucket = doc.get('bucket')
-            print(f"\nファイル {file_name} の処理を開始します...")
+            logger.info(f"ファイル {file_name} の処理を開始します...")
             
             try:
                 pdf_data = supabase.storage.from_(bucket).download(file_name)
-                print(f"ファイル {file_name} のダウンロードが完了しました")
+                logger.info(f"ファイル {file_name} のダウンロードが完了しました")
                 
-                split_pdfs = split_pdf_in_memory(pdf_data)
-                print(f"ファイル {file_name} の分割が完了しました")
+                # PdfReaderはファイルごとに1度だけ構築して使い回す
+                reader = PdfReader(io.BytesIO(pdf_data))
+                split_pdfs = split_pdf_in_memory(reader)
+                logger.info(f"ファイル {file_name} の分割が完了しました")
                 
                 for pdf in split_pdfs:
-                    print(f"\n{pdf['name']} の文字起こしを開始します...")
+                    logger.debug(f"{pdf['name']} の文字起こしを開始します...")
                     transcription = transcribe_pdf(pdf['data'], pdf['page'])
                     save_to_supabase(supabase, transcription, pdf['page'], file_name, doc_id)
                 
                 supabase.table('document_metadata').update({'status': 'processed'}).eq('file_name', file_name).execute()
-                print(f"ファイル {file_name} の処理が完了しました")
+                logger.info(f"ファイル {file_name} の処理が完了しました")
                 
             except Exception as e:
-                print(f"ファイル {file_name} の処理中にエラーが発生しました: {str(e)}")
+                logger.error(f"ファイル {file_name} の処理中にエラーが発生しました: {str(e)}")
         
     except Exception as e:
-        print(f"エラーが発生しました: {str(e)}")
+        logger.error(f"エラーが発生しました: {str(e)}")
         return None
 
 if __name__ == "__main__":
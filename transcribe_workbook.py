@@ -1,188 +1,245 @@
 import os
 import sys
-import json
+import orjson
 from dotenv import load_dotenv
 from supabase import create_client, Client
-from PyPDF2 import PdfReader, PdfWriter
+import pikepdf
 import io
+import tempfile
+import httpx
 import google.generativeai as genai
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, TypeAdapter
+from typing import List, Optional, Dict, Any, get_origin, get_args
+import asyncio
+import hashlib
+import functools
+import random
+from google.api_core import exceptions as google_exceptions
 
 load_dotenv()
 
+# 同時に処理する問題数の上限（Gemini APIのレート制限に合わせて調整）
+MAX_CONCURRENT_PROBLEMS = 8
+_SEM = asyncio.Semaphore(MAX_CONCURRENT_PROBLEMS)
+
+# 429 / 5xx / タイムアウトに対する指数バックオフの設定
+MAX_RETRIES = 5
+RETRY_MAX_DELAY = 60
+RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+)
+
+# problem_numbers/*.json の1問分（ページ番号は1始まりで、end_pageを含む）
+class Problem(BaseModel):
+    problem_number: int
+    start_page: int
+    end_page: int
+
+# 問題情報のJSONファイルを読み込み時に1度だけ検証する
+PROBLEMS_ADAPTER = TypeAdapter(List[Problem])
+
+# ダウンロードしたPDFをメモリ上に保持する上限（超えた分は一時ファイルに書き出す）
+DOWNLOAD_SPOOL_SIZE = 32 * 1024 * 1024
+SIGNED_URL_EXPIRES_IN = 3600
+
+# 構造化分析の各項目（Geminiが省略した項目は空の値で補う）
+class ProblemSummary(BaseModel):
+    physical_phenomenon: str = ""
+    main_components: str = ""
+
+class MainPhysicsField(BaseModel):
+    field: str = ""
+    subfield: str = ""
+    field_fusion: str = ""
+
+class ProblemStructure(BaseModel):
+    question_structure: str = ""
+    diagrams_graphs: str = ""
+    answer_format: str = ""
+
+class RequiredAbilities(BaseModel):
+    knowledge_application: List[str] = Field(default_factory=list)
+    physical_laws_application: List[str] = Field(default_factory=list)
+    mathematical_processing: List[str] = Field(default_factory=list)
+    reading_comprehension: List[str] = Field(default_factory=list)
+    modeling: List[str] = Field(default_factory=list)
+    experimental_interpretation: List[str] = Field(default_factory=list)
+
+class MathematicalElements(BaseModel):
+    math_level: str = ""
+    important_techniques: List[str] = Field(default_factory=list)
+    calculation_complexity: str = ""
+
+class DifficultyAssessment(BaseModel):
+    overall_level: str = ""
+    difficulty_factors: List[str] = Field(default_factory=list)
+    problem_type: str = ""
+
+class FeaturesAndNotes(BaseModel):
+    guidance_level: str = ""
+    approximation_requirements: List[str] = Field(default_factory=list)
+    novelty: str = ""
+    key_points: List[str] = Field(default_factory=list)
+    traps: List[str] = Field(default_factory=list)
+
 class PhysicsAnalysis(BaseModel):
-    problem_summary: Dict[str, str] = Field(
-        default_factory=lambda: {
-            "physical_phenomenon": "",
-            "main_components": ""
-        },
-        description="問題の要約",
-        json_schema_extra={
-            "type": "object",
-            "properties": {
-                "physical_phenomenon": {"type": "string"},
-                "main_components": {"type": "string"}
-            }
-        }
-    )
-    main_physics_field: Dict[str, str] = Field(
-        default_factory=lambda: {
-            "field": "",
-            "subfield": "",
-            "field_fusion": ""
-        },
-        description="主たる物理分野",
-        json_schema_extra={
-            "type": "object",
-            "properties": {
-                "field": {"type": "string"},
-                "subfield": {"type": "string"},
-                "field_fusion": {"type": "string"}
-            }
-        }
-    )
-    problem_structure: Dict[str, Any] = Field(
-        default_factory=lambda: {
-            "question_structure": "",
-            "diagrams_graphs": "",
-            "answer_format": ""
-        },
-        description="問題形式と構成",
-        json_schema_extra={
-            "type": "object",
-            "properties": {
-                "question_structure": {"type": "string"},
-                "diagrams_graphs": {"type": "string"},
-                "answer_format": {"type": "string"}
-            }
-        }
-    )
-    required_abilities: Dict[str, List[str]] = Field(
-        default_factory=lambda: {
-            "knowledge_application": [],
-            "physical_laws_application": [],
-            "mathematical_processing": [],
-            "reading_comprehension": [],
-            "modeling": [],
-            "experimental_interpretation": []
-        },
-        description="問われている中心的能力",
-        json_schema_extra={
-            "type": "object",
-            "properties": {
-                "knowledge_application": {"type": "array", "items": {"type": "string"}},
-                "physical_laws_application": {"type": "array", "items": {"type": "string"}},
-                "mathematical_processing": {"type": "array", "items": {"type": "string"}},
-                "reading_comprehension": {"type": "array", "items": {"type": "string"}},
-                "modeling": {"type": "array", "items": {"type": "string"}},
-                "experimental_interpretation": {"type": "array", "items": {"type": "string"}}
-            }
-        }
-    )
-    key_laws_formulas: List[str] = Field(
-        default_factory=list,
-        description="解答に必要な主要法則・公式",
-        json_schema_extra={
-            "type": "array",
-            "items": {"type": "string"}
-        }
-    )
-    mathematical_elements: Dict[str, Any] = Field(
-        default_factory=lambda: {
-            "math_level": "",
-            "important_techniques": [],
-            "calculation_complexity": ""
-        },
-        description="数学的要素の分析",
-        json_schema_extra={
-            "type": "object",
-            "properties": {
-                "math_level": {"type": "string"},
-                "important_techniques": {"type": "array", "items": {"type": "string"}},
-                "calculation_complexity": {"type": "string"}
-            }
-        }
-    )
-    difficulty_assessment: Dict[str, Any] = Field(
-        default_factory=lambda: {
-            "overall_level": "",
-            "difficulty_factors": [],
-            "problem_type": ""
-        },
-        description="難易度評価",
-        json_schema_extra={
-            "type": "object",
-            "properties": {
-                "overall_level": {"type": "string"},
-                "difficulty_factors": {"type": "array", "items": {"type": "string"}},
-                "problem_type": {"type": "string"}
-            }
-        }
-    )
-    features_and_notes: Dict[str, Any] = Field(
-        default_factory=lambda: {
-            "guidance_level": "",
-            "approximation_requirements": [],
-            "novelty": "",
-            "key_points": [],
-            "traps": []
+    problem_summary: ProblemSummary = Field(default_factory=ProblemSummary, description="問題の要約")
+    main_physics_field: MainPhysicsField = Field(default_factory=MainPhysicsField, description="主たる物理分野")
+    problem_structure: ProblemStructure = Field(default_factory=ProblemStructure, description="問題形式と構成")
+    required_abilities: RequiredAbilities = Field(default_factory=RequiredAbilities, description="問われている中心的能力")
+    key_laws_formulas: List[str] = Field(default_factory=list, description="解答に必要な主要法則・公式")
+    mathematical_elements: MathematicalElements = Field(default_factory=MathematicalElements, description="数学的要素の分析")
+    difficulty_assessment: DifficultyAssessment = Field(default_factory=DifficultyAssessment, description="難易度評価")
+    features_and_notes: FeaturesAndNotes = Field(default_factory=FeaturesAndNotes, description="問題の特徴と注意点")
+
+# 検証・変換に使うアダプタ（モジュール読み込み時に1度だけ構築して使い回す）
+PHYSICS_ADAPTER = TypeAdapter(PhysicsAnalysis)
+
+def build_response_schema(model: type[BaseModel]) -> Dict[str, Any]:
+    """pydanticモデルからGeminiに渡すresponse_schemaを組み立てる
+
+    google.generativeaiにモデルのクラスをそのまま渡すと、変換の途中でrequiredと
+    入れ子のモデルに付けたdescriptionが落ちるため、辞書のスキーマとして渡す
+    """
+    properties = {}
+    for name, field in model.model_fields.items():
+        annotation = field.annotation
+        if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            schema = build_response_schema(annotation)
+        elif annotation is str:
+            schema = {"type": "string"}
+        elif get_origin(annotation) is list and get_args(annotation) == (str,):
+            schema = {"type": "array", "items": {"type": "string"}}
+        else:
+            raise TypeError(f"{model.__name__}.{name} の型 {annotation} はスキーマに変換できません")
+        if field.description:
+            schema["description"] = field.description
+        properties[name] = schema
+    return {"type": "object", "properties": properties, "required": list(properties)}
+
+PHYSICS_SCHEMA = build_response_schema(PhysicsAnalysis)
+
+# Gemini APIの初期化（プロセス内で1度だけ行いモデルと生成設定を再利用）
+genai.configure(api_key=os.environ.get("GOOGLE_API_KEY"))
+
+# 文字起こし用のモデル・プロンプト・生成設定
+_TRANSCRIBE_MODEL = genai.GenerativeModel(
+    'gemini-2.5-flash-preview-04-17',
+    system_instruction='''
+    あなたは正確な文字起こしAIです。与えられたPDFを正確に文字起こししてください。
+    数式はTex形式で出力してください。
+    pdf内にグラフや図表があった場合、グラフや図表の説明を文字起こしした文章の適切な位置に挿入してください。
+    ページ番号やヘッダーフッターに書かれた共通の章タイトルを含めることを禁止します。
+    回答は全て日本語で行なってください。
+    '''
+)
+
+_TRANSCRIBE_PROMPT = '''
+与えられたPDFから問題文と解答を正確に文字起こししてください。
+問題文と解答は分けて出力してください。
+'''
+
+_TRANSCRIBE_CONFIG = {
+    'response_mime_type': 'application/json',
+    'response_schema': {
+        "type": "object",
+        "properties": {
+            "question": {"type": "string"},
+            "answer": {"type": "string"}
         },
-        description="問題の特徴と注意点",
-        json_schema_extra={
-            "type": "object",
-            "properties": {
-                "guidance_level": {"type": "string"},
-                "approximation_requirements": {"type": "array", "items": {"type": "string"}},
-                "novelty": {"type": "string"},
-                "key_points": {"type": "array", "items": {"type": "string"}},
-                "traps": {"type": "array", "items": {"type": "string"}}
-            }
-        }
-    )
+        "required": ["question", "answer"]
+    }
+}
+
+# 分析用のモデル（環境変数ANALYZE_MODELで変更可能。proは遅く高価なため既定はflash）
+MODEL_ANALYZE = os.environ.get("ANALYZE_MODEL", "gemini-2.5-flash-preview-04-17")
+_ANALYZE_MODEL = genai.GenerativeModel(
+    MODEL_ANALYZE,
+    system_instruction='''
+    あなたは優秀な物理学者です。与えられた問題文と解答を以下の指標に従って詳細に分析しMarkdown形式で出力してください。数式はTex形式で出力してください。
+    結果のみ出力してください。
+
+    問題設定の要約:
+        扱っている物理現象・状況の簡単な説明（例：単振り子の運動、RLC回路の過渡現象、気体の状態変化と熱効率）
+        主要な構成要素（物体、場、装置など）
+    主たる物理分野:
+        該当する分野を特定（力学、熱力学、波動、電磁気学、原子物理）
+        （該当する場合）分野内の詳細テーマ（例：力学→円運動、電磁気学→コンデンサー）
+        （該当する場合）複数分野の融合度（どの分野がどのように関連しているか）
+    問題形式と構成:
+        大問・小問の構成（設問数、独立性、連続性）
+        図・グラフの有無とその役割（状況理解補助、データ提示、解答の一部）
+        想定される解答形式（選択、数値記入、記号選択、記述説明、途中式記述、グラフ描画）
+    問われている中心的能力:
+        知識・公式の理解と適用
+        物理法則の応用・深い考察
+        数学的処理能力（計算、近似、ベクトル、微積分）
+        読解力・情報整理能力
+        モデル化・仮定の設定能力
+        実験・観察データの解釈・考察能力
+    解答に必要な主要法則・公式:
+        問題解決に不可欠な物理法則、原理、公式を列挙（例：運動量保存則、エネルギー保存則、キルヒホッフの法則、熱力学第一法則、光の干渉条件）
+    数学的要素の分析:
+        要求される数学レベル（例：数I・A、数II・B、数III）
+        特に重要な数学的手法（例：三角関数、ベクトル、微分、積分、近似計算）
+        計算量の評価（少ない、標準的、多い、複雑）
+    難易度評価:
+        総合的な難易度レベル（基礎、標準、応用、難関）
+        難易度を構成する要因（設定の複雑さ、思考ステップ数、計算量、見慣れない題材、時間制限）
+        問題の典型度（典型問題、標準的な応用問題、思考力重視の独自問題）
+    問題の特徴と注意点:
+        誘導の丁寧さ（丁寧なステップ、ヒント少なめ、自力での思考要求）
+        近似計算の要否とその種類（例：微小角近似 sinθ≈θ, (1+x)^n≈1+nx）
+        設定の新規性・独創性
+        解法のポイント、注意すべき物理的・数学的トラップ
+
+    回答は全て日本語で行なってください。
+    '''
+)
+
+# 構造化用のモデルと生成設定
+_STRUCTURE_MODEL = genai.GenerativeModel(
+    'gemini-1.5-flash',
+    system_instruction='''
+    あなたは正確なjson変換マシーンです。与えられた分析結果を、jsonデータに変換して出力してください。
+    '''
+)
 
-def transcribe_pdf(pdf_data, problem_number: int) -> tuple[str, str]:
+_STRUCTURE_CONFIG = {
+    'response_mime_type': 'application/json',
+    'response_schema': PHYSICS_SCHEMA,
+}
+
+async def generate_with_retry(model: genai.GenerativeModel, contents, label: str, **kwargs):
+    """一時的なエラー（429 / 5xx / タイムアウト）の場合は指数バックオフで再試行してコンテンツを生成"""
+    for attempt in range(MAX_RETRIES):
+        try:
+            # ストリーミングで受信し、長い出力でも生成中に接続が切られないようにする
+            response = await model.generate_content_async(contents, stream=True, **kwargs)
+            await response.resolve()
+            return response
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            delay = min(RETRY_MAX_DELAY, 2 ** attempt + random.random())
+            print(f"{label} のリクエストが一時的に失敗しました。{delay:.1f}秒後に再試行します: {str(e)}")
+            await asyncio.sleep(delay)
+
+async def transcribe_pdf(pdf_data, problem_number: int) -> tuple[str, str]:
     """PDFデータを文字起こし（問題文と解答を分けて）"""
     try:
-        # Gemini APIの初期化
-        genai.configure(api_key=os.environ.get("GOOGLE_API_KEY"))
-        model = genai.GenerativeModel(
-            'gemini-2.5-flash-preview-04-17',
-            system_instruction='''
-            あなたは正確な文字起こしAIです。与えられたPDFを正確に文字起こししてください。
-            数式はTex形式で出力してください。
-            pdf内にグラフや図表があった場合、グラフや図表の説明を文字起こしした文章の適切な位置に挿入してください。
-            ページ番号やヘッダーフッターに書かれた共通の章タイトルを含めることを禁止します。
-            回答は全て日本語で行なってください。
-            '''
-        )
-        
-        # 文字起こしの実行
-        prompt = '''
-        与えられたPDFから問題文と解答を正確に文字起こししてください。
-        問題文と解答は分けて出力してください。
-        '''
-        
-        # 生成設定の定義
-        generation_config = {
-            'response_mime_type': 'application/json',
-            'response_schema': {
-                "type": "object",
-                "properties": {
-                    "question": {"type": "string"},
-                    "answer": {"type": "string"}
-                },
-                "required": ["question", "answer"]
-            }
-        }
-        
-        # コンテンツの生成
-        response = model.generate_content(
-            contents=[
-                prompt,
+        # コンテンツの生成（問題ごとのPDFは小さいためリクエストに直接含める）
+        response = await generate_with_retry(
+            _TRANSCRIBE_MODEL,
+            [
+                _TRANSCRIBE_PROMPT,
                 {"mime_type": "application/pdf", "data": pdf_data}
             ],
-            generation_config=generation_config
+            f"問題 {problem_number} の文字起こし",
+            generation_config=_TRANSCRIBE_CONFIG
         )
         
         # レスポンスの検証
@@ -196,62 +253,19 @@ def transcribe_pdf(pdf_data, problem_number: int) -> tuple[str, str]:
         print("\n" + "="*50 + "\n")
         
         # テキストをJSONに変換
-        json_data = json.loads(response.text)
+        json_data = orjson.loads(response.text)
         return json_data["question"], json_data["answer"]
         
     except Exception as e:
         print(f"問題 {problem_number} の文字起こし中にエラーが発生しました: {str(e)}")
         return "", ""
 
-def analyze_problem(question: str, answer: str) -> str:
+async def analyze_problem(question: str, answer: str) -> str:
     """問題文と解答を分析して解説を生成"""
+    if not (question.strip() or answer.strip()):
+        return ""
+    
     try:
-        # Gemini APIの初期化
-        genai.configure(api_key=os.environ.get("GOOGLE_API_KEY"))
-        model = genai.GenerativeModel(
-            'gemini-2.5-pro-preview-03-25',
-            system_instruction='''
-            あなたは優秀な物理学者です。与えられた問題文と解答を以下の指標に従って詳細に分析しMarkdown形式で出力してください。数式はTex形式で出力してください。
-            結果のみ出力してください。
-
-            問題設定の要約:
-                扱っている物理現象・状況の簡単な説明（例：単振り子の運動、RLC回路の過渡現象、気体の状態変化と熱効率）
-                主要な構成要素（物体、場、装置など）
-            主たる物理分野:
-                該当する分野を特定（力学、熱力学、波動、電磁気学、原子物理）
-                （該当する場合）分野内の詳細テーマ（例：力学→円運動、電磁気学→コンデンサー）
-                （該当する場合）複数分野の融合度（どの分野がどのように関連しているか）
-            問題形式と構成:
-                大問・小問の構成（設問数、独立性、連続性）
-                図・グラフの有無とその役割（状況理解補助、データ提示、解答の一部）
-                想定される解答形式（選択、数値記入、記号選択、記述説明、途中式記述、グラフ描画）
-            問われている中心的能力:
-                知識・公式の理解と適用
-                物理法則の応用・深い考察
-                数学的処理能力（計算、近似、ベクトル、微積分）
-                読解力・情報整理能力
-                モデル化・仮定の設定能力
-                実験・観察データの解釈・考察能力
-            解答に必要な主要法則・公式:
-                問題解決に不可欠な物理法則、原理、公式を列挙（例：運動量保存則、エネルギー保存則、キルヒホッフの法則、熱力学第一法則、光の干渉条件）
-            数学的要素の分析:
-                要求される数学レベル（例：数I・A、数II・B、数III）
-                特に重要な数学的手法（例：三角関数、ベクトル、微分、積分、近似計算）
-                計算量の評価（少ない、標準的、多い、複雑）
-            難易度評価:
-                総合的な難易度レベル（基礎、標準、応用、難関）
-                難易度を構成する要因（設定の複雑さ、思考ステップ数、計算量、見慣れない題材、時間制限）
-                問題の典型度（典型問題、標準的な応用問題、思考力重視の独自問題）
-            問題の特徴と注意点:
-                誘導の丁寧さ（丁寧なステップ、ヒント少なめ、自力での思考要求）
-                近似計算の要否とその種類（例：微小角近似 sinθ≈θ, (1+x)^n≈1+nx）
-                設定の新規性・独創性
-                解法のポイント、注意すべき物理的・数学的トラップ
-
-            回答は全て日本語で行なってください。
-            '''
-        )
-        
         # 分析の実行
         prompt = f'''
         問題文:
@@ -261,7 +275,7 @@ def analyze_problem(question: str, answer: str) -> str:
         {answer}
         '''
         
-        response = model.generate_content(prompt)
+        response = await generate_with_retry(_ANALYZE_MODEL, prompt, "問題の分析")
         print(response.text)
         if not response.text:
             print("問題の分析がスキップされました")
@@ -273,28 +287,18 @@ def analyze_problem(question: str, answer: str) -> str:
         print(f"問題の分析中にエラーが発生しました: {str(e)}")
         return ""
 
-def structure_analysis(analysis: str) -> Dict[str, Any]:
+async def structure_analysis(analysis: str) -> Dict[str, Any]:
     """問題文、解答、解説を構造化された分析データに変換"""
+    if not analysis.strip():
+        return {}
+    
     try:
-        # Gemini APIの初期化
-        genai.configure(api_key=os.environ.get("GOOGLE_API_KEY"))
-        model = genai.GenerativeModel(
-            'gemini-1.5-flash',
-            system_instruction='''
-            あなたは正確なjson変換マシーンです。与えられた分析結果を、jsonデータに変換して出力してください。
-            '''
-        )
-        
-        # 生成設定の定義
-        generation_config = {
-            'response_mime_type': 'application/json',
-            'response_schema': PhysicsAnalysis,
-        }
-        
         # コンテンツの生成
-        response = model.generate_content(
-            contents=[analysis],
-            generation_config=generation_config
+        response = await generate_with_retry(
+            _STRUCTURE_MODEL,
+            [analysis],
+            "構造化分析",
+            generation_config=_STRUCTURE_CONFIG
         )
         
         # レスポンスの検証
@@ -307,50 +311,179 @@ def structure_analysis(analysis: str) -> Dict[str, Any]:
         print(response.text)
         print("\n" + "="*50 + "\n")
         
-        # テキストをJSONに変換してPhysicsAnalysisに変換
-        json_data = json.loads(response.text)
-        result = PhysicsAnalysis(**json_data)
+        # JSONのパースとPhysicsAnalysisの検証を1回で行う
+        result = PHYSICS_ADAPTER.validate_json(response.text)
         
-        # 結果を辞書形式で返す
-        return result.model_dump()
+        # Supabaseのjsonカラムにそのまま渡せる辞書として返す（pydantic-core内で1回の変換）
+        return PHYSICS_ADAPTER.dump_python(result, mode='json')
         
     except Exception as e:
         print(f"構造化分析中にエラーが発生しました: {str(e)}")
         return {}
 
-def save_to_supabase(supabase: Client, question: str, answer: str, analysis: str, structured_analysis: dict, problem_number: int, file_name: str, document_id: str):
-    """文字起こし結果をSupabaseに保存"""
+def save_to_supabase(supabase: Client, results: List[Dict[str, Any]]):
+    """文字起こし結果を1回のinsertでまとめてSupabaseに保存（失敗した場合は1件ずつ保存）"""
     try:
-        data = {
-            "question": question,
-            "answer": answer,
-            "analysis": analysis,
-            "structured_analysis": structured_analysis,
-            "problem_number": problem_number,
-            "file_name": file_name,
-            "document_id": document_id
-        }
-        
-        response = supabase.table('workbook_transcriptions').insert(data).execute()
-        print(f"問題 {problem_number} の結果を保存しました")
+        response = supabase.table('workbook_transcriptions').insert(results).execute()
+        print(f"{len(results)} 問の結果を保存しました")
         return response.data
     except Exception as e:
-        print(f"保存中にエラーが発生しました: {str(e)}")
-        return None
+        print(f"一括保存中にエラーが発生しました。1件ずつ保存します: {str(e)}")
+    
+    saved = []
+    for data in results:
+        try:
+            response = supabase.table('workbook_transcriptions').insert(data).execute()
+            saved.extend(response.data)
+        except Exception as e:
+            print(f"問題 {data['problem_number']} の保存中にエラーが発生しました: {str(e)}")
+    print(f"{len(saved)} / {len(results)} 問の結果を保存しました")
+    return saved
+
+def split_problem_pdf(pdf: pikepdf.Pdf, buffer: io.BytesIO, start_page: int, end_page: int) -> bytes:
+    """指定されたページ範囲（1始まり、end_pageを含む）を1つのPDFとして切り出す"""
+    with pikepdf.Pdf.new() as dst:
+        # ページ範囲をまとめて追加（qpdfが参照オブジェクトを共有してコピーする）
+        dst.pages.extend(pdf.pages[start_page - 1:end_page])
+        
+        # ファイル内の全問題で同じバッファを使い回す
+        # /IDを内容から決めて、同じページ範囲からは同じバイト列（＝同じpdf_sha）を得る
+        buffer.seek(0)
+        buffer.truncate()
+        dst.save(buffer, deterministic_id=True)
+    with buffer.getbuffer() as view:
+        return view.tobytes()
+
+def find_cached_result(supabase: Client, pdf_sha: str) -> Optional[Dict[str, Any]]:
+    """同じ内容のPDFを文字起こし済みの行があれば取得（pdf_shaはPDFデータのsha256）"""
+    response = (
+        supabase.table('workbook_transcriptions')
+        .select("question, answer, analysis, structured_analysis")
+        .eq('pdf_sha', pdf_sha)
+        .neq('question', "")
+        .limit(1)
+        .execute()
+    )
+    return response.data[0] if response.data else None
+
+async def process_problem(supabase: Client, pdf: pikepdf.Pdf, buffer: io.BytesIO, problem: Problem, file_name: str, document_id: str) -> Dict[str, Any]:
+    """1問分のPDFを切り出して文字起こし・分析・構造化し、保存する行データを返す"""
+    async with _SEM:
+        print(f"\n問題 {problem.problem_number} の処理を開始します...")
+        pdf_sha = None
+        
+        try:
+            # 問題ごとにPDFを分割
+            pdf_chunk = split_problem_pdf(pdf, buffer, problem.start_page, problem.end_page)
+            pdf_sha = hashlib.sha256(pdf_chunk).hexdigest()
+            
+            # 同じ内容のPDFの結果が保存済みであれば再利用し、Geminiの呼び出しを省く
+            try:
+                cached = await asyncio.to_thread(find_cached_result, supabase, pdf_sha)
+            except Exception as e:
+                print(f"キャッシュの確認中にエラーが発生しました: {str(e)}")
+                cached = None
+            
+            if cached:
+                print(f"問題 {problem.problem_number} は保存済みの文字起こしを再利用します")
+                question, answer = cached['question'], cached['answer']
+            else:
+                # 文字起こしの実行
+                try:
+                    question, answer = await transcribe_pdf(pdf_chunk, problem.problem_number)
+                except Exception as e:
+                    print(f"文字起こし中にエラーが発生しました: {str(e)}")
+                    question, answer = "", ""
+            
+            # 問題の分析を実行（同じ問題文と解答から作られた分析があれば再利用）
+            if cached and cached.get('analysis'):
+                analysis = cached['analysis']
+            elif not (question or answer):
+                # 文字起こしに失敗した問題は分析しない
+                analysis = ""
+            else:
+                try:
+                    analysis = await analyze_problem(question, answer)
+                except Exception as e:
+                    print(f"問題分析中にエラーが発生しました: {str(e)}")
+                    analysis = ""
+            
+            # 構造化分析を実行
+            if cached and cached.get('analysis') and cached.get('structured_analysis'):
+                structured_analysis = cached['structured_analysis']
+            elif not analysis:
+                # 分析に失敗した問題は構造化しない
+                structured_analysis = {}
+            else:
+                try:
+                    structured_analysis = await structure_analysis(analysis)
+                except Exception as e:
+                    print(f"構造化分析中にエラーが発生しました: {str(e)}")
+                    structured_analysis = {}
+            
+            # 結果を返す（エラーが発生しても空のデータとして保存）
+            return {
+                "question": question,
+                "answer": answer,
+                "analysis": analysis,
+                "structured_analysis": structured_analysis,
+                "problem_number": problem.problem_number,
+                "file_name": file_name,
+                "document_id": document_id,
+                "pdf_sha": pdf_sha
+            }
+        
+        except Exception as e:
+            print(f"問題 {problem.problem_number} の処理中にエラーが発生しました: {str(e)}")
+            # エラーが発生しても空のデータとして保存
+            return {
+                "question": "",
+                "answer": "",
+                "analysis": "",
+                "structured_analysis": {},
+                "problem_number": problem.problem_number,
+                "file_name": file_name,
+                "document_id": document_id,
+                "pdf_sha": pdf_sha
+            }
+
+@functools.lru_cache(maxsize=None)
+def get_supabase() -> Client:
+    """プロセス内で共有するSupabaseクライアントを取得（HTTP接続と認証情報を再利用）"""
+    supabase_url = os.environ.get("SUPABASE_URL")
+    supabase_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
+    return create_client(supabase_url, supabase_key)
 
-def process_workbook(problems_file, target_file_name):
+async def download_workbook(http: httpx.AsyncClient, supabase: Client, file_name: str) -> tempfile.SpooledTemporaryFile:
+    """署名付きURLからPDFをストリーミングでダウンロード（大きなPDFは一時ファイルに退避）"""
+    signed = await asyncio.to_thread(
+        supabase.storage.from_('workbooks').create_signed_url, file_name, SIGNED_URL_EXPIRES_IN
+    )
+    tf = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_SIZE)
+    try:
+        async with http.stream('GET', signed['signedURL']) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                tf.write(chunk)
+        tf.seek(0)
+        return tf
+    except Exception:
+        tf.close()
+        raise
+
+async def process_workbook(http: httpx.AsyncClient, problems_file, target_file_name):
     try:
         # 問題情報のJSONファイルを読み込み
-        with open(problems_file, 'r') as f:
-            problems = json.load(f)
+        with open(problems_file, 'rb') as f:
+            problems = PROBLEMS_ADAPTER.validate_json(f.read())
         
-        # Supabaseクライアントの初期化
-        supabase_url = os.environ.get("SUPABASE_URL")
-        supabase_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
-        supabase: Client = create_client(supabase_url, supabase_key)
+        # Supabaseクライアントの取得（プロセス内で共有）
+        supabase = get_supabase()
         
         # 指定されたファイル名のドキュメントを取得
-        response = supabase.table('document_metadata').select("*").eq('file_name', target_file_name).execute()
+        response = await asyncio.to_thread(
+            supabase.table('document_metadata').select("*").eq('file_name', target_file_name).execute
+        )
         
         if not response.data:
             print(f"ファイル {target_file_name} が見つかりませんでした。")
@@ -362,86 +495,31 @@ def process_workbook(problems_file, target_file_name):
         
         try:
             # Storageからファイルをダウンロード
-            pdf_data = supabase.storage.from_('workbooks').download(file_name)
-            print(f"ファイル {file_name} のダウンロードが完了しました")
-            
-            # PDFリーダーの初期化
-            reader = PdfReader(io.BytesIO(pdf_data))
-            
-            # 各問題を順次処理
-            for problem in problems:
-                print(f"\n問題 {problem['problem_number']} の処理を開始します...")
+            with await download_workbook(http, supabase, file_name) as pdf_file:
+                print(f"ファイル {file_name} のダウンロードが完了しました")
                 
-                try:
-                    # 問題ごとにPDFを分割
-                    writer = PdfWriter()
-                    start_page = problem['start_page']
-                    end_page = problem['end_page']
-                    
-                    # 指定されたページ範囲のページを追加
-                    for page_num in range(start_page - 1, end_page):
-                        if page_num < len(reader.pages):
-                            writer.add_page(reader.pages[page_num])
-                    
-                    # メモリ上でPDFを保持
+                # PDFを開いて全問題で共有（qpdfは多少壊れたPDFも修復して読み込む）
+                with pikepdf.open(pdf_file) as pdf:
+                    # 各問題を並列に処理（同時実行数は_SEMで制限）
+                    # 分割は待機を挟まずに行うため、問題間でバッファを共有できる
                     buffer = io.BytesIO()
-                    writer.write(buffer)
-                    pdf_chunk = buffer.getvalue()
-                    
-                    # 文字起こしの実行
-                    try:
-                        question, answer = transcribe_pdf(pdf_chunk, problem['problem_number'])
-                    except Exception as e:
-                        print(f"文字起こし中にエラーが発生しました: {str(e)}")
-                        question, answer = "", ""
-                    
-                    # 問題の分析を実行
-                    try:
-                        analysis = analyze_problem(question, answer)
-                    except Exception as e:
-                        print(f"問題分析中にエラーが発生しました: {str(e)}")
-                        analysis = ""
-                    
-                    # 構造化分析を実行
-                    try:
-                        structured_analysis = structure_analysis(analysis)
-                    except Exception as e:
-                        print(f"構造化分析中にエラーが発生しました: {str(e)}")
-                        structured_analysis = {}
-                    
-                    # 結果を保存（エラーが発生しても空のデータとして保存）
-                    save_to_supabase(
-                        supabase,
-                        question,
-                        answer,
-                        analysis,
-                        structured_analysis,
-                        problem['problem_number'],
-                        file_name,
-                        doc['id']
-                    )
-                    
-                    # メモリの解放
-                    del writer
-                    del buffer
-                    del pdf_chunk
-                
-                except Exception as e:
-                    print(f"問題 {problem['problem_number']} の処理中にエラーが発生しました: {str(e)}")
-                    # エラーが発生しても空のデータとして保存
-                    save_to_supabase(
-                        supabase,
-                        "",
-                        "",
-                        "",
-                        {},
-                        problem['problem_number'],
-                        file_name,
-                        doc['id']
+                    results = await asyncio.gather(
+                        *(process_problem(supabase, pdf, buffer, problem, file_name, doc['id']) for problem in problems),
+                        return_exceptions=True
                     )
             
+            # 全問題の結果をまとめて保存
+            results = [result for result in results if isinstance(result, dict)]
+            saved = await asyncio.to_thread(save_to_supabase, supabase, results) if results else []
+            if not saved:
+                # 1行も保存できなかった場合は、次回に再処理できるようstatusを更新しない
+                print(f"ファイル {file_name} の結果を保存できなかったため、statusを更新しません")
+                return None
+            
             # 処理完了後にstatusを更新
-            supabase.table('document_metadata').update({'status': 'processed_divided'}).eq('file_name', file_name).execute()
+            await asyncio.to_thread(
+                supabase.table('document_metadata').update({'status': 'processed_divided'}).eq('file_name', file_name).execute
+            )
             print(f"ファイル {file_name} の処理が完了しました")
             
         except Exception as e:
@@ -451,11 +529,28 @@ def process_workbook(problems_file, target_file_name):
         print(f"エラーが発生しました: {str(e)}")
         return None
 
+async def process_workbooks(docs: List[Dict[str, Any]]):
+    """processedなworkbookファイルを順に処理（ファイル内の問題は並列に処理）"""
+    # ダウンロード用のHTTPクライアントは全ファイルで共有する
+    async with httpx.AsyncClient() as http:
+        for doc in docs:
+            file_name = doc.get('file_name')
+            if not file_name:
+                continue
+                
+            # JSONファイル名を生成（.pdfを.jsonに置換）
+            json_file = 'problem_numbers/' + file_name.replace('.pdf', '.json')
+            
+            if not os.path.exists(json_file):
+                print(f"JSONファイル {json_file} が見つかりませんでした。スキップします。")
+                continue
+            
+            print(f"\n=== {file_name} の処理を開始します ===")
+            await process_workbook(http, json_file, file_name)
+
 if __name__ == "__main__":
     # Supabaseクライアントの初期化
-    supabase_url = os.environ.get("SUPABASE_URL")
-    supabase_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
-    supabase: Client = create_client(supabase_url, supabase_key)
+    supabase = get_supabase()
     
     # deleted_appliedステータスのドキュメントを取得して削除処理
     delete_response = supabase.table('document_metadata').select("*").eq('status', 'deleted_applied').execute()
@@ -487,17 +582,4 @@ if __name__ == "__main__":
         sys.exit(0)
     
     # 各ファイルを処理
-    for doc in response.data:
-        file_name = doc.get('file_name')
-        if not file_name:
-            continue
-            
-        # JSONファイル名を生成（.pdfを.jsonに置換）
-        json_file = 'problem_numbers/' + file_name.replace('.pdf', '.json')
-        
-        if not os.path.exists(json_file):
-            print(f"JSONファイル {json_file} が見つかりませんでした。スキップします。")
-            continue
-        
-        print(f"\n=== {file_name} の処理を開始します ===")
-        process_workbook(json_file, file_name)
+    asyncio.run(process_workbooks(response.data))
@@ -0,0 +1,3 @@
+-- 同じ内容の問題PDFの文字起こし結果を再利用するため、PDFデータのsha256を保存する
+alter table workbook_transcriptions add column if not exists pdf_sha text;
+create index if not exists workbook_transcriptions_pdf_sha_idx on workbook_transcriptions (pdf_sha);